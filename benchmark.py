@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+# benchmarks for the efabless tool, run from the repo directory
+import os, sys, time, shutil, tempfile, hashlib, logging, argparse, tracemalloc, subprocess
+
+import efabless_tool
+
+page_template = '''<html><head><title>Project Detail | Efabless</title></head><body>
+<span class="text-dark-50 font-weight-bold">Shuttle</span>
+<span class="text-dark-50 font-weight-bold"> MPW-{mpw} </span>
+<div class="list-group-item py-2"><h6>Owner</h6><p> Owner {owner} </p></div>
+<div class="list-group-item py-2"><h6>Summary</h6><p>Synthetic project {id}
+with an op-amp, a {ip} and some padding {padding}</p></div>
+<div class="list-group-item py-2"><h6>Git URL</h6><p>https://github.com/user{owner}/project{id}.git</p></div>
+<div class="list-group-item py-2"><h6>Process</h6><p>sky130{process}</p></div>
+<div class="list-group-item py-2"><h6>Last MPW Precheck</h6><p>Succeeded</p></div>
+<div class="list-group-item py-2"><h6>Last Tapeout</h6><p>{tapeout}</p></div>
+</body></html>
+'''
+
+
+# project pages rebuilt from projects.db in the site's layout, some with fields missing, always checked
+fixtures_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'pages')
+
+# pages that have tripped up the streaming parser
+edge_pages = {
+    'script': page_template.replace('<p>Synthetic project {id}', '<p>Synthetic <script>var x = "{id}";</script>project {id}<style>p {{}}</style>'),
+    'no_p': page_template.replace('<p>sky130{process}</p>', 'sky130{process}'),
+    'entities': page_template.replace('Owner {owner}', 'Owner &amp; {owner}<br>&lt;x&gt;<!-- c -->'),
+    'unclosed': page_template.replace('</p></div>\n<div class="list-group-item py-2"><h6>Process', '</div>\n<div class="list-group-item py-2"><h6>Process'),
+    }
+
+
+# the original BeautifulSoup parser from efabless_tool, to check the streaming parser against
+def parse_page_soup(filename, content):
+    from bs4 import BeautifulSoup
+    project = {}
+    soup = BeautifulSoup(content, 'html.parser')
+    assert 'Project Detail | Efabless' in soup.title.text
+    divs = soup.find_all("div", {"class": "list-group-item py-2"})
+    project['id'] = filename
+    for div in divs:
+        key = div.h6.text
+        value = div.p.text.strip()
+        if key in efabless_tool.key_map:
+            project[efabless_tool.key_map[key]] = value
+
+    mpw_header = soup.find_all("span", {"class": "text-dark-50 font-weight-bold"})
+    if len(mpw_header) > 0:
+        project['mpw'] = mpw_header[1].text.strip()
+
+    return project
+
+
+def parse_or_error(parse, filename, content):
+    # a page one parser rejects must be rejected by the other
+    try:
+        return parse(filename, content)
+    except (AttributeError, ValueError):
+        return 'error'
+
+
+def make_corpus(path, pages):
+    # deterministic synthetic project pages
+    os.makedirs(os.path.join(path, efabless_tool.cached_project_dir))
+    ips = ['pll', 'adc', 'dac', 'risc-v core', 'sram', 'reram']
+    for i in range(1, pages + 1):
+        page = page_template.format(id=i, mpw=i % 8, owner=i % 97, ip=ips[i % len(ips)],
+                                    padding='x' * (i % 500), process='AB'[i % 2],
+                                    tapeout='Succeeded' if i % 3 else 'Failed')
+        with open(os.path.join(path, efabless_tool.cached_project_dir, str(i)), 'w') as fh:
+            fh.write(page)
+    shutil.copy('selected', path)
+
+
+def digest(path):
+    with open(path, 'rb') as fh:
+        return hashlib.sha256(fh.read()).hexdigest()
+
+
+def bench_parse(jobs):
+    # serial vs process pool parsing, output must be identical
+    results = {}
+    for n in [1, jobs]:
+        now = time.time()
+        efabless_tool.parse_project_page(jobs=n)
+        results[n] = (time.time() - now, digest(efabless_tool.projects_db))
+        print("parse jobs=%-3d %6.2f s" % (n, results[n][0]))
+    assert results[1][1] == results[jobs][1], "parallel output differs from serial"
+
+
+def read_pages(pages_dir):
+    pages = []
+    for filename in sorted(os.listdir(pages_dir)):
+        with open(os.path.join(pages_dir, filename)) as fh:
+            pages.append((filename, fh.read()))
+    return pages
+
+
+def bench_page_parser(pages_dir):
+    # streaming page parser against the BeautifulSoup one: same result, time and peak memory per page
+    pages = read_pages(pages_dir)
+
+    checks = read_pages(fixtures_dir) + pages + [(name, page.format(id=1, mpw=1, owner=1, ip='pll', padding='', process='A', tapeout='Failed'))
+                      for name, page in edge_pages.items()]
+    for filename, content in checks:
+        assert parse_or_error(efabless_tool.parse_page, filename, content) == parse_or_error(parse_page_soup, filename, content), \
+            "page_parser differs from BeautifulSoup on %s" % filename
+    print("page parser matches BeautifulSoup on %d pages" % len(checks))
+
+    for parse in [parse_page_soup, efabless_tool.parse_page]:
+        now = time.time()
+        for filename, content in pages:
+            parse(filename, content)
+        per_page = (time.time() - now) / len(pages)
+
+        tracemalloc.start()
+        filename, content = pages[-1]
+        parse(filename, content)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print("%-16s %8.3f ms/page %8d kB peak" % (parse.__name__, per_page * 1000, peak // 1024))
+
+
+def make_projects(count):
+    # deterministic synthetic catalog
+    ips = ['pll', 'adc', 'dac', 'risc-v core', 'sram', 'reram']
+    return [{'id': str(i), 'precheck': 'Succeeded', 'tapeout': 'Succeeded' if i % 3 else 'Failed',
+             'giturl': 'https://github.com/user%d/project%d.git' % (i % 97, i), 'mpw': 'MPW-%d' % (i % 8),
+             'owner': 'Owner %d' % (i % 97), 'process': 'sky130' + 'AB'[i % 2],
+             'summary': 'Synthetic project %d with an op-amp, a %s and some padding %s' % (i, ips[i % len(ips)], 'x' * (i % 500)),
+             'selected': 'yes' if i % 5 else 'no'} for i in range(1, count + 1)]
+
+
+def bench_load(count):
+    # loading every column against just the ones a command needs: time and peak memory
+    path = os.path.join(tempfile.mkdtemp(), efabless_tool.projects_db)
+    try:
+        efabless_tool.project_store.save(path, make_projects(count))
+        loads = [
+            ('all columns', None, {}),
+            ('owner,giturl', ['owner', 'giturl'], {}),
+            ('mpw,selected,tapeout', ['mpw', 'selected', 'tapeout'], {}),
+            ('owner,giturl mpw=MPW-3', ['owner', 'giturl'], {'mpw': 'MPW-3'}),
+            ]
+        for name, columns, where in loads:
+            now = time.time()
+            efabless_tool.project_store.load(path, None, columns, **where)
+            took = time.time() - now
+
+            tracemalloc.start()
+            efabless_tool.project_store.load(path, None, columns, **where)
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            print("load %-24s %8.1f ms %8d kB peak" % (name, took * 1000, peak // 1024))
+    finally:
+        shutil.rmtree(os.path.dirname(path))
+
+
+def bench_diff(count):
+    # change feed between two synthetic catalogs, a few percent of the projects changed
+    old_projects = make_projects(count)
+    new_projects = [dict(project) for project in old_projects[count // 100:]] + make_projects(count + count // 100)[count:]
+    for project in new_projects[::37]:
+        project['tapeout'] = 'Succeeded'
+    now = time.time()
+    changes = {}
+    for change in efabless_tool.project_store.diff(old_projects, new_projects):
+        changes[change['change']] = changes.get(change['change'], 0) + 1
+    print("diff %d projects %8.1f ms %s" % (count, (time.time() - now) * 1000, changes))
+
+
+# query commands to time the startup of
+startup_commands = [
+    ['--help'],
+    ['--list'],
+    ['--show', '--id', '1000'],
+    ['--ip', 'opamp'],
+    ['--ip', 'opamp', '--fuzzy'],
+    ['--stats', '--group-by', 'mpw'],
+    ['--list', '--format', 'jsonl'],
+    ]
+
+
+def bench_startup(runs):
+    # wall time and total import time from python -X importtime for each query command
+    tool = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'efabless_tool.py')
+    for command in startup_commands:
+        wall = []
+        imports = []
+        for i in range(runs):
+            now = time.time()
+            result = subprocess.run([sys.executable, '-X', 'importtime', tool] + command,
+                                    stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+            wall.append(time.time() - now)
+            # self time is the first column, in us
+            imports.append(sum(int(line.split('|')[0].split(':')[1]) for line in result.stderr.splitlines()
+                               if line.startswith('import time:') and 'self' not in line))
+        print("%-30s %7.1f ms %7.1f ms imports" % (' '.join(command), min(wall) * 1000, min(imports) / 1000))
+
+
+# query commands as a pipeline stage, with the project ids piped in
+daemon_commands = [
+    ['--show'],
+    ['--list'],
+    ['--ip', 'opamp'],
+    ['--stats', '--group-by', 'mpw'],
+    ]
+
+
+def bench_daemon(runs):
+    # wall time of each query command run directly and through the query daemon, output must be identical
+    tool_dir = os.path.dirname(os.path.abspath(__file__))
+    tool = os.path.join(tool_dir, 'efabless_tool.py')
+    ids = ''.join(project['id'] + '\n' for project in efabless_tool.project_store.load(os.path.join(tool_dir, efabless_tool.projects_db)))
+
+    def run(command):
+        wall = []
+        for i in range(runs):
+            now = time.time()
+            result = subprocess.run([sys.executable, tool] + command, input=ids, capture_output=True, text=True)
+            wall.append(time.time() - now)
+        return min(wall), result.stdout
+
+    direct = {}
+    for command in daemon_commands:
+        direct[' '.join(command)] = run(command + ['--no-daemon'])
+
+    daemon = subprocess.Popen([sys.executable, tool, '--daemon'], stdin=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        while not os.path.exists(os.path.join(tool_dir, efabless_tool.query_socket)):
+            time.sleep(0.05)
+        for command in daemon_commands:
+            name = ' '.join(command)
+            wall, stdout = run(command)
+            assert stdout == direct[name][1], "daemon output differs for %s" % name
+            print("%-30s %7.1f ms direct %7.1f ms daemon" % (name, direct[name][0] * 1000, wall * 1000))
+    finally:
+        daemon.terminate()
+        daemon.wait()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Efabless project tool benchmarks")
+    parser.add_argument('--pages', help="number of synthetic project pages", type=int, default=3000)
+    parser.add_argument('--jobs', help="number of processes for the parallel parse", type=int, default=os.cpu_count())
+    parser.add_argument('--runs', help="runs of each command for the startup and daemon benchmarks, the fastest is shown", type=int, default=5)
+    parser.add_argument('--projects', help="number of synthetic projects for the load and diff benchmarks", type=int, default=50000)
+    parser.add_argument('--bench', help="comma separated benchmarks to run", default='parse,page_parser,startup,daemon,load,diff')
+    parser.add_argument('--pages-dir', help="check the page parser against saved pages in this directory instead of synthetic ones")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    benches = args.bench.split(',')
+    if 'startup' in benches:
+        bench_startup(args.runs)
+    if 'daemon' in benches:
+        bench_daemon(args.runs)
+    if 'load' in benches:
+        bench_load(args.projects)
+    if 'diff' in benches:
+        bench_diff(args.projects)
+    if 'parse' not in benches and 'page_parser' not in benches:
+        exit(0)
+
+    tmp_dir = tempfile.mkdtemp()
+    pages_dir = os.path.join(tmp_dir, efabless_tool.cached_project_dir)
+    if args.pages_dir:
+        pages_dir = os.path.abspath(args.pages_dir)
+    try:
+        make_corpus(tmp_dir, args.pages)
+        os.chdir(tmp_dir)
+        if 'parse' in benches:
+            bench_parse(args.jobs)
+        if 'page_parser' in benches:
+            bench_page_parser(pages_dir)
+    finally:
+        shutil.rmtree(tmp_dir)
@@ -1,13 +1,41 @@
 #!/usr/bin/env python3
-import os, shutil, pickle, time, sys, logging, argparse, re
+# the standard library up front, the heavy modules are imported where they are used to keep startup fast
+import os, time, sys, logging, argparse, re, json, csv, random, hashlib, pickle
+import project_store
 
 # pipe handling
 from signal import signal, SIGPIPE, SIG_DFL
 signal(SIGPIPE, SIG_DFL)
 
 mpw_ids = [1, 2, 5, 6, 9, 10, 11]
-projects_db = 'projects.pkl'
+projects_db = 'projects.db'
 cached_project_dir = 'cached_pages'
+efabless_url = 'https://platform.efabless.com'
+# per URL etag, last modified, content hash and fetch time for incremental updates
+cache_manifest = 'cached_pages.json'
+# content hash to parsed project for incremental parsing
+parsed_pages_db = 'parsed_pages.json'
+# record of the crawl so far, for --resume
+crawl_journal = 'crawl_journal.jsonl'
+# the query daemon listens here
+query_socket = '.efabless_tool.sock'
+
+# crawl limits: requests in flight start low and adapt up to the max
+start_requests = 8
+max_requests = 40
+request_timeout = 30
+max_retries = 5
+backoff_base = 1
+retry_statuses = [429, 500, 502, 503, 504]
+
+# GitHub API requests in flight for --get-file and --get-pins, and how many can go before they are paced to the rate limit
+git_requests = 10
+git_burst = 1000
+# files fetched from the project repos are kept here, least recently used dropped past the size
+file_cache_dir = 'cached_files'
+file_cache_size = 500 << 20
+# local clones of the project repos for --mirror
+mirror_dir = 'mirrors'
 
 # some projects don't have all keys, so set them to none
 key_map = {
@@ -21,6 +49,9 @@ key_map = {
     'Selected'          : 'selected'
     }
 
+# results are written here, diagnostics go to stderr through logging
+output = sys.stdout
+
 format_map = {
     'id'        : '{:5.5}',
     'precheck'  : '{:10.10}',
@@ -34,72 +65,388 @@ format_map = {
     }
 
 
-# async code from
-# https://gist.github.com/wfng92/2d2ae4385badd0f78612e447444c195f
-async def gather_with_concurrency(n, *tasks):
-    semaphore = asyncio.Semaphore(n)
+class FetchError(Exception):
+    def __init__(self, message, status=None, retry_after=None):
+        super().__init__(message)
+        self.retryable = status in retry_statuses
+        self.retry_after = retry_after
+
+
+def check_status(response, what):
+    if response.status == 200:
+        return
+    retry_after = response.headers.get('Retry-After', '')
+    retry_after = int(retry_after) if retry_after.isdigit() else None
+    raise FetchError("%s returned status %d" % (what, response.status), response.status, retry_after)
+
+
+class ConcurrencyController:
+    """
+    Limits the requests in flight. The limit grows by one after a limit's worth of quick
+    successful requests and halves on throttling, errors or responses much slower than the best seen.
+    """
+
+    def __init__(self, start, maximum):
+        self.limit = start
+        self.maximum = maximum
+        self.in_flight = 0
+        self.successes = 0
+        self.best_latency = None
+        self.condition = asyncio.Condition()
+
+    async def acquire(self):
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.in_flight < self.limit)
+            self.in_flight += 1
+
+    async def release(self, latency=None):
+        # latency is None for a failed request
+        async with self.condition:
+            self.in_flight -= 1
+            if latency is not None and (self.best_latency is None or latency < self.best_latency):
+                self.best_latency = latency
+            if latency is None or (latency > 1 and latency > 4 * self.best_latency):
+                self.limit = max(1, self.limit // 2)
+                self.successes = 0
+                logging.debug("backing off, max requests %d" % self.limit)
+            else:
+                self.successes += 1
+                if self.successes >= self.limit and self.limit < self.maximum:
+                    self.limit += 1
+                    self.successes = 0
+                    logging.debug("speeding up, max requests %d" % self.limit)
+            self.condition.notify_all()
+
+
+async def with_retry(what, controller, request):
+    # request returns a new coroutine for each attempt
+    for attempt in range(max_retries + 1):
+        await controller.acquire()
+        now = time.time()
+        try:
+            result = await request()
+        except (FetchError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+            retryable = getattr(e, 'retryable', True)
+            await controller.release(None if retryable else time.time() - now)
+            if not retryable or attempt == max_retries:
+                raise FetchError("%s failed after %d attempts: %s" % (what, attempt + 1, repr(e))) from e
+            # jittered exponential backoff, unless the server said how long to wait
+            delay = getattr(e, 'retry_after', None) or random.uniform(0, backoff_base * 2 ** attempt)
+            logging.debug("retrying %s in %.1f s: %s" % (what, delay, repr(e)))
+            await asyncio.sleep(delay)
+            continue
+        await controller.release(time.time() - now)
+        return result
+
+
+async def get_async(url, session, manifest):
+    logging.debug("fetching URL %s" % url)
+    i = url.split('/')[-1]
+    entry = manifest.get(url, {})
+    cached = os.path.exists(os.path.join(cached_project_dir, i))
+
+    # conditional request if we have seen this page before and still have it
+    headers = {}
+    if cached and 'etag' in entry:
+        headers['If-None-Match'] = entry['etag']
+    if cached and 'last_modified' in entry:
+        headers['If-Modified-Since'] = entry['last_modified']
+
+    async with session.get(url, headers=headers) as response:
+        if response.status == 304:
+            logging.debug("not modified %s" % url)
+            entry['fetched'] = time.time()
+            return None
+        # anything else is an error page, keep the old entry and page
+        check_status(response, url)
+        obj = await response.text()
 
-    async def sem_task(task):
-        async with semaphore:
-            return await task
+    new_entry = {
+        'hash'      : page_hash(obj),
+        'fetched'   : time.time(),
+        }
+    if 'ETag' in response.headers:
+        new_entry['etag'] = response.headers['ETag']
+    if 'Last-Modified' in response.headers:
+        new_entry['last_modified'] = response.headers['Last-Modified']
 
-    return await asyncio.gather(*(sem_task(task) for task in tasks))
+    # only keep pages that have changed since the last fetch
+    if entry.get('hash') == new_entry['hash'] and cached:
+        logging.debug("unchanged %s" % url)
+        manifest[url] = new_entry
+        return None
+    # the manifest is updated once the page is written
+    return obj, new_entry
 
 
-async def get_async(url, session, results):
-    logging.debug("fetching URL %s" % url)
-    async with session.get(url) as response:
-        i = url.split('/')[-1]
-        obj = await response.text()
-        results[i] = obj
+def page_hash(content):
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
 
 
-def get_urls_from_index():
-    urls = []
-    # shuttle encoding is found from inspecting the link of the 'showcase' button on https://platform.efabless.com/
-    for shuttle, mpw in enumerate(mpw_ids):
-        data = urllib.parse.urlencode({'filters': f'shuttle_{mpw}'}).encode('utf-8')
-        request = urllib.request.Request('https://platform.efabless.com/projects/projects_search_results', data)
-        with urllib.request.urlopen(request) as f:
-            shuttle_soup = BeautifulSoup(f.read(), 'html.parser')
-            paths = [p['href'] for p in shuttle_soup.select('a[href^="/projects/"]')]
-            paths = ['https://platform.efabless.com' + x for x in paths]
-            logging.info("fetched {} urls for shuttle {}".format(len(paths), shuttle))
-        urls += paths
-    return urls
-
-
-async def fetch_project_urls(urls, limit):
-    conn = aiohttp.TCPConnector(limit=None, ttl_dns_cache=300)
-    session = aiohttp.ClientSession(connector=conn)
-    results = {}
+def list_cached_pages():
+    # skip hidden files, they are pages still being written
+    return [filename for filename in os.listdir(cached_project_dir) if not filename.startswith('.')]
 
-    # allow limiting for testing
-    if limit != 0:
-        urls = urls[0:limit]
 
-    conc_req = 40
-    logging.info("starting to fetch async, max requests %d" % conc_req)
-    now = time.time()
-    await gather_with_concurrency(conc_req, *[get_async(i, session, results) for i in urls])
-    time_taken = time.time() - now
+def write_page(filename, content):
+    # write to a temporary file and rename, so a crash never leaves half a page in the cache
+    path = os.path.join(cached_project_dir, filename)
+    tmp_path = os.path.join(cached_project_dir, '.' + filename)
+    with open(tmp_path, 'w') as fh:
+        fh.write(content)
+    os.replace(tmp_path, path)
 
-    logging.info("time taken = %d s" % time_taken)
-    await session.close()
 
-    logging.info("writing all pages to local cache %s" % cached_project_dir)
+def load_manifest():
+    try:
+        with open(cache_manifest) as fh:
+            return json.load(fh)
+    except FileNotFoundError:
+        return {}
+
+
+def save_manifest(manifest):
+    with open(cache_manifest, 'w') as fh:
+        json.dump(manifest, fh, indent=1, sort_keys=True)
+
+
+class CrawlJournal:
+    """
+    Append only record of the shuttle index pages and project pages fetched so far,
+    so an interrupted --update-cache can be resumed without fetching them again.
+    """
+
+    def __init__(self, resume):
+        # shuttle id to project urls
+        self.shuttles = {}
+        # project url to manifest entry
+        self.fetched = {}
+        if resume:
+            self.load()
+        # start again from what was read, so a record cut short by a crash isn't joined onto the next one
+        tmp_path = crawl_journal + '.tmp'
+        self.fh = open(tmp_path, 'w')
+        for mpw, urls in self.shuttles.items():
+            self.write({'shuttle': mpw, 'urls': urls})
+        for url, entry in self.fetched.items():
+            self.write({'url': url, 'entry': entry})
+        os.replace(tmp_path, crawl_journal)
+
+    def load(self):
+        try:
+            with open(crawl_journal) as fh:
+                for line in fh:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # last line may be cut short by the crash
+                        continue
+                    if 'shuttle' in record:
+                        self.shuttles[record['shuttle']] = record['urls']
+                    else:
+                        self.fetched[record['url']] = record['entry']
+        except FileNotFoundError:
+            return
+        logging.info("resuming crawl, %d shuttles and %d projects already fetched" % (len(self.shuttles), len(self.fetched)))
+
+    def write(self, record):
+        self.fh.write(json.dumps(record) + '\n')
+        self.fh.flush()
+
+    def add_shuttle(self, mpw, urls):
+        self.shuttles[mpw] = urls
+        self.write({'shuttle': mpw, 'urls': urls})
+
+    def add_url(self, url, entry):
+        self.fetched[url] = entry
+        self.write({'url': url, 'entry': entry})
+
+    def finish(self):
+        # the crawl completed, nothing to resume
+        self.fh.close()
+        os.remove(crawl_journal)
+
+
+def parse_index(content):
+    from bs4 import BeautifulSoup
+    shuttle_soup = BeautifulSoup(content, 'html.parser')
+    paths = [p['href'] for p in shuttle_soup.select('a[href^="/projects/"]')]
+    return [efabless_url + x for x in paths]
+
+
+async def get_index_async(shuttle, mpw, session):
+    # shuttle encoding is found from inspecting the link of the 'showcase' button on https://platform.efabless.com/
+    data = {'filters': f'shuttle_{mpw}'}
+    async with session.post(efabless_url + '/projects/projects_search_results', data=data) as response:
+        check_status(response, "index for shuttle %d" % shuttle)
+        content = await response.text()
+    paths = await asyncio.get_running_loop().run_in_executor(None, parse_index, content)
+    logging.info("fetched {} urls for shuttle {}".format(len(paths), shuttle))
+    return paths
 
-    if os.path.exists(cached_project_dir):
-        shutil.rmtree(cached_project_dir)
 
-    os.makedirs(cached_project_dir)
+async def fetch_project_urls(limit, journal, incremental=False, parse=False):
+    conn = aiohttp.TCPConnector(limit=None, ttl_dns_cache=300)
+    session = aiohttp.ClientSession(connector=conn, timeout=aiohttp.ClientTimeout(total=request_timeout))
+    controller = ConcurrencyController(start_requests, max_requests)
+
+    # a full update starts from an empty manifest so every page is fetched and rewritten
+    manifest = load_manifest() if incremental else {}
+    # skip pages fetched before an interrupted crawl
+    manifest.update(journal.fetched)
+    os.makedirs(cached_project_dir, exist_ok=True)
+
+    # pages are written as soon as they arrive and then parsed, bounded queues keep memory flat
+    conc_req = max_requests
+    url_queue = asyncio.Queue(maxsize=conc_req * 2)
+    page_queue = asyncio.Queue(maxsize=conc_req * 2)
+    parse_queue = asyncio.Queue(maxsize=conc_req * 2)
+    # every listed project url, shuttles whose index couldn't be fetched and (url, reason) for failed requests
+    urls = set()
+    failed_shuttles = []
+    failures = []
+    # content hash to parsed project, for pages parsed while fetching
+    parsed = {}
+    written = []
+
+    async def produce_shuttle(shuttle, mpw):
+        # project urls are queued as soon as each shuttle index arrives
+        if mpw in journal.shuttles:
+            paths = journal.shuttles[mpw]
+        else:
+            try:
+                paths = await with_retry("index for shuttle %d" % shuttle, controller,
+                                         lambda: get_index_async(shuttle, mpw, session))
+            except FetchError as e:
+                logging.warning(e)
+                failed_shuttles.append(mpw)
+                failures.append(("shuttle %d" % shuttle, str(e)))
+                return
+            journal.add_shuttle(mpw, paths)
+        for url in paths:
+            # allow limiting for testing
+            if url in urls or (limit != 0 and len(urls) >= limit):
+                continue
+            urls.add(url)
+            if url not in journal.fetched:
+                await url_queue.put(url)
+
+    async def produce():
+        await asyncio.gather(*[produce_shuttle(shuttle, mpw) for shuttle, mpw in enumerate(mpw_ids)])
+        for i in range(conc_req):
+            await url_queue.put(None)
+
+    async def fetch():
+        while True:
+            url = await url_queue.get()
+            if url is None:
+                return
+            try:
+                page = await with_retry(url, controller, lambda: get_async(url, session, manifest))
+            except FetchError as e:
+                logging.warning(e)
+                failures.append((url, str(e)))
+                continue
+            if page is None:
+                journal.add_url(url, manifest.get(url, {}))
+            else:
+                await page_queue.put((url,) + page)
+
+    async def fetch_all():
+        await asyncio.gather(produce(), *[fetch() for i in range(conc_req)])
+        await page_queue.put(None)
+
+    async def write():
+        while True:
+            page = await page_queue.get()
+            if page is None:
+                await parse_queue.put(None)
+                return
+            url, content, entry = page
+            filename = url.split('/')[-1]
+            write_page(filename, content)
+            manifest[url] = entry
+            journal.add_url(url, entry)
+            written.append(filename)
+            if parse:
+                await parse_queue.put((filename, content))
+
+    async def parse_pages():
+        # parse in a thread so the fetches carry on
+        loop = asyncio.get_running_loop()
+        while True:
+            page = await parse_queue.get()
+            if page is None:
+                return
+            filename, content = page
+            project = await loop.run_in_executor(None, try_parse_page, filename, content)
+            if project is not None:
+                parsed[page_hash(content)] = project
+
+    logging.info("starting to fetch async, max requests %d" % max_requests)
+    now = time.time()
+    tasks = [asyncio.create_task(task) for task in [fetch_all(), write(), parse_pages()]]
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        # keep the manifest for the pages written so far, even if the crawl failed
+        for task in tasks:
+            task.cancel()
+        await session.close()
+        save_manifest(manifest)
+    time_taken = time.time() - now
 
-    for key in results:
-        with open(os.path.join(cached_project_dir, key), 'w') as fh:
-            fh.write(results[key])
+    logging.info("time taken = %d s, finished with max requests %d" % (time_taken, controller.limit))
+    logging.info("%d of %d pages changed in local cache %s" % (len(written), len(urls), cached_project_dir))
+
+    # drop pages for projects that are no longer listed, unless a shuttle is missing
+    if (limit == 0 or not incremental) and not failed_shuttles:
+        for url in list(manifest):
+            if url not in urls:
+                del manifest[url]
+        listed = set(url.split('/')[-1] for url in urls)
+        for filename in os.listdir(cached_project_dir):
+            if filename not in listed:
+                logging.info("removing %s" % filename)
+                os.remove(os.path.join(cached_project_dir, filename))
+        save_manifest(manifest)
+
+    if failures:
+        logging.warning("%d requests failed:" % len(failures))
+        for _, reason in failures:
+            logging.warning("  %s" % reason)
+
+    return parsed, failures
+
+
+def parse_page(filename, content):
+    import page_parser
+    project = {}
+    title, fields, headers = page_parser.parse(content)
+    assert 'Project Detail | Efabless' in title
+    project['id'] = filename
+    logging.info(filename)
+    for key, value in fields:
+        value = value.strip()
+        if key in key_map:
+            project[key_map[key]] = value
+
+    if len(headers) > 0:
+        project['mpw'] = headers[1].strip()
+
+    return project
+
+
+def try_parse_page(filename, content):
+    # a page that doesn't look like a project page is skipped rather than stopping the update
+    try:
+        return parse_page(filename, content)
+    except (AssertionError, ValueError, TypeError, IndexError) as e:
+        logging.warning("couldn't parse page %s: %s" % (filename, repr(e)))
+        return None
 
 
-def parse_project_page():
+def parse_project_page(incremental=False, jobs=1, parsed_pages=None):
     logging.info("parsing project pages")
     projects = []
     selected = []
@@ -109,110 +456,398 @@ def parse_project_page():
         for id in fh.readlines():
             selected.append(id.strip())
 
-    for filename in os.listdir(cached_project_dir):
+    # pages parsed by the last run, keyed by content hash
+    index = {}
+    if incremental:
+        try:
+            with open(parsed_pages_db) as fh:
+                index = json.load(fh)
+        except FileNotFoundError:
+            pass
+        except ValueError:
+            logging.warning("%s is damaged, parsing all the pages" % parsed_pages_db)
+    # pages already parsed while fetching
+    if parsed_pages is not None:
+        index.update(parsed_pages)
+
+    pages = []
+    for filename in list_cached_pages():
         with open(os.path.join(cached_project_dir, filename)) as fh:
-            project = {}
             content = fh.read()
-            soup = BeautifulSoup(content, 'html.parser')
-            assert 'Project Detail | Efabless' in soup.title.text
-            divs = soup.find_all("div", {"class": "list-group-item py-2"})
-            project['id'] = filename
-            logging.info(filename)
-            for div in divs:
-                key = div.h6.text
-                value = div.p.text.strip()
-                if key in key_map:
-                    project[key_map[key]] = value
-
-
-            mpw_header = soup.find_all("span",{"class": "text-dark-50 font-weight-bold"})
-            if len(mpw_header) > 0:
-                project['mpw'] = mpw_header[1].text.strip()
-
-            if project['id'] in selected:
-                project['selected'] = 'yes'
-
-            # fill in any blanks
-            for key in key_map.values():
-                if key not in project:
-                    project[key] = 'n/a'
-
-            # remove newlines from summary
-            project['summary'] = project['summary'].replace('\n', ' ')
-
-            projects.append(project)
-
-    logging.info("dumping project info to local cache %s" % projects_db)
-    with open(projects_db, 'wb') as fh:
-        pickle.dump(projects, fh)
+        digest = page_hash(content)
+        pages.append((filename, content, digest))
+
+    # only parse pages that aren't in the index
+    todo = [(filename, content) for filename, content, digest in pages
+            if digest not in index or index[digest]['id'] != filename]
+    if jobs > 1 and len(todo) > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        logging.info("parsing %d pages with %d jobs" % (len(todo), jobs))
+        with ProcessPoolExecutor(jobs) as pool:
+            parsed_pages = list(pool.map(try_parse_page, *zip(*todo), chunksize=max(1, len(todo) // (jobs * 4))))
+    else:
+        parsed_pages = [try_parse_page(filename, content) for filename, content in todo]
+    parsed = {page['id']: page for page in parsed_pages if page is not None}
+
+    # merge in directory order so the output is the same however it was parsed
+    new_index = {}
+    for filename, content, digest in pages:
+        page = parsed.get(filename) or index.get(digest)
+        if page is None:
+            continue
+        new_index[digest] = page
+
+        project = dict(page)
+        if project['id'] in selected:
+            project['selected'] = 'yes'
+
+        # fill in any blanks
+        for key in key_map.values():
+            if key not in project:
+                project[key] = 'n/a'
+
+        # remove newlines from summary
+        project['summary'] = project['summary'].replace('\n', ' ')
+
+        projects.append(project)
+
+    logging.info("parsed %d of %d pages" % (len(parsed), len(projects)))
+    with open(parsed_pages_db, 'w') as fh:
+        json.dump(new_index, fh)
+
+    logging.info("saving project info to local cache %s" % projects_db)
+    project_store.save(projects_db, projects)
+
+
+def read_ids(lines):
+    # ids at the start of lines, eg from --list
+    ids = []
+    for line in lines:
+        m = re.search(r'^(\d+)\s', line)
+        if m is not None:
+            ids.append(m.group(1))
+    return ids
+
+
+def parse_ids(ids):
+    # comma separated ids and ranges, eg 1,5,1000-1010
+    parsed = []
+    for part in ids.split(','):
+        if '-' in part:
+            start, end = part.split('-')
+            parsed.append((int(start), int(end)))
+        else:
+            parsed.append(str(int(part)))
+    return parsed
+
+
+def expand_ids(id_list, projects_by_id):
+    # known ids in order, ranges only select the projects that exist
+    ids = []
+    for item in id_list:
+        if isinstance(item, tuple):
+            ids += [id for id in projects_by_id if item[0] <= int(id) <= item[1]]
+        elif item in projects_by_id:
+            ids.append(item)
+        else:
+            logging.warning("project %s not found" % item)
+    return ids
+
+
+def select_by_id(projects, id_lists):
+    # projects with ids in all of the lists, in the order of the first
+    projects_by_id = {project['id']: project for project in projects}
+    ids = expand_ids(id_lists[0], projects_by_id)
+    for id_list in id_lists[1:]:
+        other = set(expand_ids(id_list, projects_by_id))
+        ids = [id for id in ids if id in other]
+    return [projects_by_id[id] for id in ids]
 
 
 def show_project(projects):
     for project in projects:
         for key in project:
-            logging.info("{:20}{}".format(key, project[key]))
+            output.write("{:20}{}\n".format(key, project[key]))
+
+
+def write_projects(projects, fields, output_format):
+    # machine readable output, nothing truncated
+    if output_format == 'parquet':
+        try:
+            import pyarrow, pyarrow.parquet
+        except ImportError:
+            logging.error("parquet output needs pyarrow, pip3 install pyarrow")
+            exit(1)
+        table = pyarrow.table({field: [project[field] for project in projects] for field in fields})
+        output.flush()
+        pyarrow.parquet.write_table(table, output.buffer)
+    elif output_format == 'jsonl':
+        for project in projects:
+            output.write(json.dumps({field: project[field] for field in fields}) + '\n')
+    else:
+        writer = csv.writer(output, delimiter='\t' if output_format == 'tsv' else ',', lineterminator='\n')
+        writer.writerow(fields)
+        for project in projects:
+            writer.writerow([project[field] for field in fields])
+
+
+def write_diff(changes, output_format):
+    # one line per added or removed project and per changed field
+    if output_format == 'jsonl':
+        for change in changes:
+            output.write(json.dumps(change) + '\n')
+    elif output_format in ('csv', 'tsv'):
+        writer = csv.writer(output, delimiter='\t' if output_format == 'tsv' else ',', lineterminator='\n')
+        writer.writerow(['id', 'change', 'field', 'old', 'new'])
+        for change in changes:
+            for field, (old, new) in change.get('fields', {'': ['', '']}).items():
+                writer.writerow([change['id'], change['change'], field, old, new])
+    else:
+        template = make_template(['id']) + '{:8} ' + make_template(['mpw', 'owner', 'summary'])
+        for change in changes:
+            if change['change'] == 'changed':
+                for field, (old, new) in change['fields'].items():
+                    output.write(make_template(['id']).format(change['id']) + "changed  %-9s %s -> %s\n" % (field, old, new))
+            else:
+                project = change['project']
+                output.write(template.format(change['id'], change['change'], project['mpw'], project['owner'], project['summary']) + '\n')
+
+
+def make_template(fields):
+    # one format string for a whole line
+    return ''.join(format_map[field] + ' ' for field in fields)
 
 
 def list_projects(projects, fields):
     # always include id as first field
-    fields = 'id,' + fields
+    fields = [field for field in ('id,' + fields).split(',') if field in format_map]
+    template = make_template(fields)
     for project in projects:
-        log = ''
-        for field in fields.split(','):
-            if field in project:
-                log += format_map[field].format(project[field])
-                log += " "
-        logging.info(log)
+        output.write(template.format(*[project[field] for field in fields]) + '\n')
 
 
-def list_by_ip(projects, ip):
-    ip = re.sub("-", "", ip)
+def project_stats(projects, group_by):
+    # one pass: group to [projects, selected, tapeouts, succeeded tapeouts]
+    groups = {}
+    fields = group_by.split(',') if group_by else []
     for project in projects:
-        log = ''
-        if re.search(ip, project["summary"], re.IGNORECASE):
-            for field in ["id", "owner", "giturl"]:
-                log += format_map[field].format(project[field])
-                if re.search("n/a", log):
-                    log = re.sub("n/a", "[github link not found] https://platform.efabless.com/projects/{0}".format(project["id"]), log)
-                log += " "
-            logging.info(log)
-
-
-def get_file(projects, path):
-    from get_pins import fetch_file_from_git
-    for project in projects:
-        fetched = fetch_file_from_git(project, path)
-        logging.info(project['giturl'])
-        print(fetched.decode('utf-8'))
+        counts = groups.setdefault(tuple(project[field] for field in fields), [0, 0, 0, 0])
+        counts[0] += 1
+        if project['selected'] == 'yes':
+            counts[1] += 1
+        if project['tapeout'] != 'n/a':
+            counts[2] += 1
+            if 'Succeeded' in project['tapeout']:
+                counts[3] += 1
+
+    template = make_template(fields)
+    output.write(template.format(*fields) + "%8s %8s %9s %8s %9s\n" % ("projects", "selected", "selected%", "tapeouts", "success%"))
+    for group in sorted(groups):
+        count, selected, tapeouts, succeeded = groups[group]
+        success = "%9.1f" % (100 * succeeded / tapeouts) if tapeouts else "%9s" % "n/a"
+        output.write(template.format(*group) + "%8d %8d %9.1f %8d %s\n" % (count, selected, 100 * selected / count, tapeouts, success))
+
+
+def list_by_ip(projects, ip, fuzzy=False, top=10, db=projects_db):
+    # best matches first, limited to the selected projects
+    projects_by_id = {project['id']: project for project in projects}
+    if fuzzy:
+        # the top matches among the selected projects, not the top matches of all of them
+        matches = project_store.fuzzy_search(db, ip, top, list(projects_by_id))
+        for id, similarity in matches:
+            logging.debug("%s matched %d%%" % (id, similarity * 100))
+        ids = [id for id, similarity in matches]
+    else:
+        ids = project_store.search(db, ip)
+    template = make_template(['id', 'owner', 'giturl'])
+    for id in ids:
+        if id not in projects_by_id:
+            continue
+        project = projects_by_id[id]
+        giturl = project['giturl']
+        if giturl == 'n/a':
+            giturl = "[github link not found] https://platform.efabless.com/projects/{0}".format(id)
+        output.write(template.format(id, project['owner'], giturl) + '\n')
+
+
+def fetch_in_order(projects, fetch, write, offline=False, mirror=False):
+    # fetch for all the projects at once, writing the results in project order as they arrive
+    import asyncio
+
+    async def fetch_all():
+        async with client:
+            tasks = [asyncio.ensure_future(fetch(client, project)) for project in projects]
+            try:
+                for project, task in zip(projects, tasks):
+                    write(project, await task)
+            finally:
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+
+    cache = None
+    if mirror:
+        from git_mirror import GitMirror
+        client = GitMirror(mirror_dir, git_requests, offline)
+    else:
+        from get_pins import GitHubClient
+        from file_cache import FileCache
+        cache = FileCache(file_cache_dir, file_cache_size)
+        client = GitHubClient(git_requests, request_timeout, git_burst, cache, offline)
+    try:
+        asyncio.run(fetch_all())
+    finally:
+        if cache is not None:
+            cache.save()
+
+
+def get_file(projects, path, offline=False, mirror=False):
 
+    def write(project, fetched):
+        output.write(project['giturl'] + '\n')
+        if fetched is not None:
+            output.write(fetched.decode('utf-8') + '\n')
 
-def get_pins_in_lef(projects):
+    fetch_in_order(projects, lambda client, project: client.fetch_file(project, path), write, offline, mirror)
+
+
+def get_pins_in_lef(projects, offline=False, mirror=False):
     from get_pins import get_pins
-    max_pins = 0
-    max_id = None
-    for project in projects:
-        pins = get_pins(project)
-        if pins > max_pins:
-            max_pins = pins
-            max_id = project["id"]
-        logging.info("%-5s %-80s %-5s" % (project["id"], project["giturl"], pins))
-    logging.info("max pins was %d in project id %s" % (max_pins, max_id))
+    most = {'pins': 0, 'id': None}
 
+    def write(project, pins):
+        if pins > most['pins']:
+            most['pins'] = pins
+            most['id'] = project["id"]
+        output.write("%-5s %-80s %-5s\n" % (project["id"], project["giturl"], pins))
 
-if __name__ == '__main__':
+    fetch_in_order(projects, get_pins, write, offline, mirror)
+    output.write("max pins was %d in project id %s\n" % (most['pins'], most['id']))
+
+
+def make_parser():
     parser = argparse.ArgumentParser(description="Efabless project tool")
 
     parser.add_argument('--list', help="list basic project info", action='store_const', const=True)
     parser.add_argument('--fields', help="comma separated list of fields to show. To see all available fields, use the --show option", default='mpw,owner,summary,tapeout,selected')
     parser.add_argument('--show', help="show all data for given projects", action='store_const', const=True)
+    parser.add_argument('--format', help="with --list or --show, output all of each field as jsonl, csv, tsv or parquet (needs pyarrow). With --diff, jsonl, csv or tsv", choices=['jsonl', 'csv', 'tsv', 'parquet'])
     parser.add_argument('--id', help="select a project by id", type=int)
+    parser.add_argument('--ids', help="select projects by comma separated ids and ranges, eg 1,5,1000-1010")
+    parser.add_argument('--mpw', help="select the projects on a shuttle, eg MPW-7")
+    parser.add_argument('--where', help="select projects with a filter, eg 'tapeout=Succeeded and process~130B and mpw=MPW-7'. = is exact, != not equal, ~ contains, combine with and, or, not and ()")
+    parser.add_argument('--stats', help="count the projects, selected projects and successful tapeouts", action='store_const', const=True)
+    parser.add_argument('--group-by', help="comma separated fields to group --stats by, eg mpw,process")
+    parser.add_argument('--diff', help="show the projects added, removed and changed between two project caches, eg an old projects.db or projects.pkl and the current one. --mpw and --where select the projects compared", nargs=2, metavar=('OLD', 'NEW'))
     parser.add_argument('--get-pins', help="dump number of pins found in user project wrapper lef file", action='store_const', const=True)
     parser.add_argument('--get-file', help="get the specified file from the git repo")
+    parser.add_argument('--offline', help="with --get-pins or --get-file, only use the files already in the file cache, or the mirrors with --mirror", action='store_const', const=True)
+    parser.add_argument('--mirror', help="with --get-pins or --get-file, read the repos from local shallow clones instead of the GitHub API, cloning or fetching them first", action='store_const', const=True)
     parser.add_argument('--update-cache', help='fetch the project data', action='store_const', const=True)
+    parser.add_argument('--incremental', help='with --update-cache, only fetch, rewrite and parse pages that have changed', action='store_const', const=True)
+    parser.add_argument('--resume', help='with --update-cache, carry on from an interrupted update', action='store_const', const=True)
+    parser.add_argument('--jobs', help='with --update-cache, number of processes used to parse the pages', type=int, default=1)
     parser.add_argument('--limit-update', help='just fetch the given number of projects', type=int, default=0)
+    parser.add_argument('--import-pickle', help='import a projects.pkl from an older version of the tool into the project cache')
     parser.add_argument('--debug', help="debug logging", action="store_const", dest="loglevel", const=logging.DEBUG, default=logging.INFO)
-    parser.add_argument('--ip', help="get the list of all projects that has relation with the IP", type=str)
+    parser.add_argument('--ip', help="search the projects for an IP, best matches first. Words are ANDed, use 'or' or | for alternatives and word* for prefixes", type=str)
+    parser.add_argument('--fuzzy', help="with --ip, rank the summaries by how many letter trigrams they share with the search", action='store_const', const=True)
+    parser.add_argument('--top', help="with --ip --fuzzy, how many projects to show", type=int, default=10)
+    parser.add_argument('--daemon', help="run a query daemon that keeps the project cache in memory, query commands use it while it is running", action='store_const', const=True)
+    parser.add_argument('--no-daemon', help="don't use the query daemon even if it is running", action='store_const', const=True)
+    return parser
+
+
+def select_projects(args, stdin_lines, db, columns=None):
+    # load projects from cache, sorted by ID, with just the columns the command needs
+    where = {}
+    if args.mpw:
+        where['mpw'] = args.mpw
+    projects = project_store.load(db, args.where, columns, **where)
+
+    # ID selection by stdin, --id and --ids, in the order given
+    id_lists = []
+    if stdin_lines is not None:
+        id_lists.append(read_ids(stdin_lines))
+    if args.id:
+        id_lists.append([str(args.id)])
+    if args.ids:
+        id_lists.append(parse_ids(args.ids))
+    if id_lists:
+        projects = select_by_id(projects, id_lists)
+    return projects
+
+
+def is_query(args):
+    # commands that only read the project store
+    return bool(args.list or args.show or args.stats or args.group_by or args.ip)
+
+
+def check_fields(fields):
+    for field in fields:
+        if field not in format_map:
+            raise ValueError("unknown field %s" % field)
+
+
+def run_query(args, stdin_lines, db):
+    # raises ValueError for bad arguments
+    if (args.list or args.show) and args.format:
+        # id first and each field once, in the order given
+        fields = project_store.fields if args.show else list(dict.fromkeys(['id'] + args.fields.split(',')))
+        check_fields(fields)
+        write_projects(select_projects(args, stdin_lines, db, fields), fields, args.format)
+
+    elif args.list:
+        # unknown fields are left out of the listing
+        fields = [field for field in args.fields.split(',') if field in format_map]
+        list_projects(select_projects(args, stdin_lines, db, fields), args.fields)
+
+    elif args.show:
+        show_project(select_projects(args, stdin_lines, db))
+
+    elif args.stats or args.group_by:
+        fields = args.group_by.split(',') if args.group_by else []
+        check_fields(fields)
+        project_stats(select_projects(args, stdin_lines, db, fields + ['selected', 'tapeout']), args.group_by)
+
+    elif args.ip:
+        list_by_ip(select_projects(args, stdin_lines, db, ['owner', 'giturl']), args.ip, args.fuzzy, args.top, db)
+
+
+def handle_query(argv, stdin_lines, db):
+    # run a query for the daemon, returning what it would have printed
+    global output
+    import io
+    args = make_parser().parse_args(argv)
+    results = output
+    output = io.StringIO()
+    errors = io.StringIO()
+    handler = logging.StreamHandler(errors)
+    handler.setLevel(args.loglevel)
+    logging.getLogger('').addHandler(handler)
+    status = 0
+    try:
+        run_query(args, stdin_lines, db)
+    except ValueError as e:
+        # as parser.error would have printed it
+        parser = make_parser()
+        errors.write(parser.format_usage() + "%s: error: %s\n" % (parser.prog, e))
+        status = 2
+    finally:
+        logging.getLogger('').removeHandler(handler)
+        reply = {'output': output.getvalue(), 'errors': errors.getvalue(), 'status': status}
+        output = results
+    return reply
+
+
+if __name__ == '__main__':
+    parser = make_parser()
     args = parser.parse_args()
+    # paths given are relative to where we are run from
+    if args.diff:
+        args.diff = [os.path.abspath(path) for path in args.diff]
+    if args.import_pickle:
+        args.import_pickle = os.path.abspath(args.import_pickle)
 
     # change directory to the script's path
     os.chdir((os.path.dirname(os.path.realpath(__file__))))
@@ -222,66 +857,114 @@ if __name__ == '__main__':
     # configure the client logging
     log = logging.getLogger('')
     # has to be set to debug as is the root logger
-    log.setLevel(args.loglevel)
+    log.setLevel(logging.DEBUG)
 
-    # create console handler and set level to info
-    ch = logging.StreamHandler(sys.stdout)
+    # create console handler and set level to info, on stderr to keep it out of the results
+    ch = logging.StreamHandler(sys.stderr)
+    ch.setLevel(args.loglevel)
     # create formatter for console
     ch.setFormatter(log_format)
     log.addHandler(ch)
 
-    # load projects from cache
-    try:
-        projects = pickle.load(open(projects_db, 'rb'))
-    except FileNotFoundError:
-        logging.error("project cache %s not found, use --update-cache to build it" % projects_db)
-
-    # sort the projects by ID
-
-    projects.sort(key=lambda x: int(x['id']))
-
-    # handle ID selection by stdin
-    if not sys.stdin.isatty():
-        pre_filtered_projects = projects
-        projects = []
-        lines = sys.stdin.readlines()
-        for line in lines:
-            m = re.search(r'^(\d+)\s', line)
-            if m is not None:
-                for project in pre_filtered_projects:
-                    if project['id'] == m.group(1):
-                        projects.append(project)
+    # results are buffered when piped, line by line in a terminal
+    output = open(sys.stdout.fileno(), 'w', buffering=1 if sys.stdout.isatty() else 1 << 16,
+                  encoding=sys.stdout.encoding, errors=sys.stdout.errors, closefd=False)
 
-    # handle ID by argument
-    if args.id:
-        for project in projects:
-            if project['id'] == str(args.id):
-                projects = [project]
+    # ids can be piped in to the commands that select projects
+    stdin_lines = None
+    if not sys.stdin.isatty() and (is_query(args) or args.get_pins or args.get_file):
+        stdin_lines = sys.stdin.readlines()
 
     # deal with arguments
-    if args.list:
-        list_projects(projects, args.fields)
-
-    elif args.show:
-        show_project(projects)
-
-    elif args.get_pins:
-        get_pins_in_lef(projects)
-
-    elif args.get_file:
-        get_file(projects, args.get_file)
-
-    elif args.ip:
-        list_by_ip(projects, args.ip)
+    if args.daemon:
+        import query_daemon
+        try:
+            query_daemon.serve(projects_db, query_socket, handle_query)
+        except query_daemon.AlreadyRunning as e:
+            logging.error(e)
+            exit(1)
+
+    elif is_query(args):
+        # use the daemon if it is running, parquet is written straight to stdout so can't go through it
+        reply = None
+        if not args.no_daemon and args.format != 'parquet' and os.path.exists(query_socket):
+            import query_daemon
+            reply = query_daemon.request(query_socket, sys.argv[1:], stdin_lines)
+        if reply is not None:
+            output.write(reply['output'])
+            output.flush()
+            sys.stderr.write(reply['errors'])
+            exit(reply['status'])
+        try:
+            run_query(args, stdin_lines, projects_db)
+        except FileNotFoundError:
+            logging.error("project cache %s not found, use --update-cache to build it" % projects_db)
+            exit(1)
+        except ValueError as e:
+            parser.error(e)
+
+    elif args.get_pins or args.get_file:
+        try:
+            projects = select_projects(args, stdin_lines, projects_db)
+        except FileNotFoundError:
+            logging.error("project cache %s not found, use --update-cache to build it" % projects_db)
+            exit(1)
+        except ValueError as e:
+            parser.error(e)
+        if args.get_pins:
+            get_pins_in_lef(projects, args.offline, args.mirror)
+        else:
+            get_file(projects, args.get_file, args.offline, args.mirror)
 
     elif args.update_cache:
-        from bs4 import BeautifulSoup
         import asyncio
         import aiohttp
-        import urllib
-        urls = get_urls_from_index()
-        asyncio.run(fetch_project_urls(urls, args.limit_update))
-        projects = parse_project_page()
+        journal = CrawlJournal(args.resume)
+        # with one job, parse pages as they arrive, otherwise leave them for the process pool
+        parsed_pages, failures = asyncio.run(fetch_project_urls(args.limit_update, journal, args.incremental, args.jobs == 1))
+        projects = parse_project_page(args.incremental, args.jobs, parsed_pages)
+        # keep the journal so the failed requests can be retried
+        if failures:
+            logging.warning("update incomplete, use --resume to retry the failed requests")
+        else:
+            journal.finish()
+
+    elif args.diff:
+        if args.format == 'parquet':
+            parser.error("--diff can't be written as parquet")
+        where = {}
+        if args.mpw:
+            where['mpw'] = args.mpw
+        import sqlite3
+        snapshots = []
+        for path in args.diff:
+            try:
+                # a projects.pkl from an older version of the tool is converted in memory
+                store = project_store.load_pickle(path) if path.endswith('.pkl') else path
+                snapshots.append(project_store.load(store, args.where, **where))
+            except FileNotFoundError:
+                logging.error("project cache %s not found" % path)
+                exit(1)
+            except (sqlite3.DatabaseError, pickle.UnpicklingError, EOFError):
+                logging.error("%s isn't a project cache" % path)
+                exit(1)
+            except ValueError as e:
+                parser.error(e)
+        old_projects, new_projects = snapshots
+        write_diff(project_store.diff(old_projects, new_projects), args.format)
+
+    elif args.import_pickle:
+        try:
+            count = project_store.import_pickle(args.import_pickle, projects_db)
+        except FileNotFoundError:
+            logging.error("%s not found" % args.import_pickle)
+            exit(1)
+        except (pickle.UnpicklingError, EOFError):
+            logging.error("%s isn't a projects.pkl" % args.import_pickle)
+            exit(1)
+        logging.info("imported %d projects from %s to %s" % (count, args.import_pickle, projects_db))
 
     else:
         parser.print_help()
+
+    output.flush()
@@ -0,0 +1,82 @@
+"""
+File cache
+Files fetched from the project repos, keyed by owner/repo/ref/path, or blob/sha for git blobs. Each content is stored once under its
+hash, so the same LEF in several repos takes the space of one. index.json keeps the hash, ETag, size and
+last use of each key; the least recently used keys are dropped when the cache grows past its size.
+"""
+import os, json, time, hashlib
+
+
+class FileCache:
+
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+        self.index_path = os.path.join(path, 'index.json')
+        try:
+            with open(self.index_path) as fh:
+                self.index = json.load(fh)
+        except FileNotFoundError:
+            self.index = {}
+
+    def object_path(self, content_hash):
+        return os.path.join(self.path, 'objects', content_hash[:2], content_hash)
+
+    def get(self, key):
+        # the entry for a key, or None
+        return self.index.get(key)
+
+    def read(self, key):
+        # cached content for a key, or None
+        entry = self.index.get(key)
+        if entry is None:
+            return None
+        try:
+            with open(self.object_path(entry['hash']), 'rb') as fh:
+                content = fh.read()
+        except FileNotFoundError:
+            del self.index[key]
+            return None
+        entry['used'] = time.time()
+        return content
+
+    def put(self, key, content, etag):
+        content_hash = hashlib.sha256(content).hexdigest()
+        path = self.object_path(content_hash)
+        if not os.path.exists(path):
+            # write to a temporary file and rename, so a crash never leaves half a file in the cache
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = path + '.tmp'
+            with open(tmp_path, 'wb') as fh:
+                fh.write(content)
+            os.replace(tmp_path, path)
+        self.index[key] = {'hash': content_hash, 'etag': etag, 'size': len(content), 'used': time.time()}
+
+    def evict(self):
+        # drop least recently used keys until the contents fit, and the contents no key uses
+        sizes = {}
+        for entry in self.index.values():
+            sizes[entry['hash']] = entry['size']
+        size = sum(sizes.values())
+        users = {}
+        for key, entry in self.index.items():
+            users[entry['hash']] = users.get(entry['hash'], 0) + 1
+        for key in sorted(self.index, key=lambda key: self.index[key]['used']):
+            if size <= self.max_size:
+                break
+            content_hash = self.index.pop(key)['hash']
+            users[content_hash] -= 1
+            if users[content_hash] == 0:
+                size -= sizes[content_hash]
+                try:
+                    os.remove(self.object_path(content_hash))
+                except FileNotFoundError:
+                    pass
+
+    def save(self):
+        self.evict()
+        os.makedirs(self.path, exist_ok=True)
+        tmp_path = self.index_path + '.tmp'
+        with open(tmp_path, 'w') as fh:
+            json.dump(self.index, fh, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.index_path)
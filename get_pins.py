@@ -1,49 +1,279 @@
+import time
+import json
 import base64
-from tokens import git_token, git_username
+import asyncio
 from urllib.parse import urlparse
-from def_parser import DefParser
 import logging
-import requests
+import aiohttp
 import tempfile
 
+github_api_url = 'https://api.github.com'
 
-def fetch_file_from_git(project, path):
-    # get the basics
-    git_url = project['giturl']
+
+def credentials():
+    # (username, token) pairs, git_tokens in tokens.py to use several
+    import tokens
+    return getattr(tokens, 'git_tokens', [(tokens.git_username, tokens.git_token)])
+
+
+class Token:
+    """
+    Token tracks one API token's budget from the X-RateLimit headers as a token bucket. The bucket holds
+    up to burst requests and refills at the rate that spreads what is left of the budget until the reset.
+    """
+
+    def __init__(self, username, token, burst):
+        # authenticate for rate limiting, the header is the same for every request
+        auth_string = username + ':' + token
+        encoded = base64.b64encode(auth_string.encode('ascii'))
+        self.headers = {"authorization" : 'Basic ' + encoded.decode('ascii')}
+        self.username = username
+        self.burst = burst
+        self.bucket = burst
+        # the budget, requests left and when it resets, unknown until the first response
+        self.limit = None
+        self.remaining = None
+        self.reset = None
+        self.rate = None
+        self.in_flight = 0
+        self.updated = time.time()
+
+    def refill(self, now):
+        if self.rate:
+            self.bucket = min(self.burst, self.bucket + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait(self, now):
+        # seconds until this token can be used
+        if self.reset is not None and now >= self.reset:
+            # a new budget
+            self.remaining = self.limit
+            self.reset = self.rate = None
+            self.bucket = self.burst
+        if self.remaining is None and self.in_flight:
+            # one request at a time until we know the budget
+            return 0.1
+        if self.remaining is not None and self.remaining - self.in_flight <= 0:
+            return self.reset - now if self.reset else 0.1
+        self.refill(now)
+        if self.bucket >= 1 or not self.rate:
+            return 0
+        return (1 - self.bucket) / self.rate
+
+    def take(self):
+        self.bucket -= 1
+        self.in_flight += 1
+
+    def release(self):
+        self.in_flight -= 1
+
+    def update(self, headers):
+        remaining = headers.get('X-RateLimit-Remaining')
+        reset = headers.get('X-RateLimit-Reset')
+        if remaining is None or reset is None:
+            return
+        now = time.time()
+        self.refill(now)
+        self.remaining = int(remaining)
+        self.limit = int(headers.get('X-RateLimit-Limit', self.limit or 0)) or None
+        # a second's slack for clock differences
+        self.reset = int(reset) + 1
+        self.rate = self.remaining / max(1, self.reset - now)
+
+    def block(self, seconds):
+        # the server said to stop, eg a secondary rate limit
+        self.remaining = 0
+        self.reset = time.time() + seconds
+
+
+class RateLimitScheduler:
+    """
+    Hands out the tokens round robin, skipping any that are paced or out of requests.
+    When none can be used it waits for the first one that can, until the reset if need be.
+    """
+
+    def __init__(self, credentials, burst):
+        self.tokens = [Token(username, token, burst) for username, token in credentials]
+        self.next = 0
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        # one waiter at a time, the rest queue behind it
+        async with self.lock:
+            while True:
+                now = time.time()
+                waits = []
+                for i in range(len(self.tokens)):
+                    token = self.tokens[(self.next + i) % len(self.tokens)]
+                    wait = token.wait(now)
+                    if wait <= 0:
+                        self.next = (self.next + i + 1) % len(self.tokens)
+                        token.take()
+                        return token
+                    waits.append(wait)
+                wait = min(waits)
+                if wait > 10:
+                    logging.info("API rate limit reached, waiting %d s for the reset" % wait)
+                await asyncio.sleep(wait)
+
+
+class GitHubClient:
+    """
+    GitHubClient keeps one keep-alive session for all the API requests, with at most
+    concurrency of them in flight, paced by the rate limits of the tokens in tokens.py.
+    Files are kept in cache, a FileCache, and revalidated with their ETag; offline only uses the cache.
+    Use it with async with so the session is closed.
+    """
+
+    def __init__(self, concurrency=10, timeout=30, burst=1000, cache=None, offline=False):
+        self.api_url = github_api_url
+        self.headers = {"Accept": "application/vnd.github.v3.raw"}
+        self.cache = cache
+        self.offline = offline
+        # no tokens needed offline
+        self.scheduler = None if offline else RateLimitScheduler(credentials(), burst)
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.session = None
+        # blob sha to the task fetching it, so each blob is only fetched once per run
+        self.blobs = {}
+        self.timeout = timeout
+        self.concurrency = concurrency
+
+    async def __aenter__(self):
+        if not self.offline:
+            conn = aiohttp.TCPConnector(limit=self.concurrency, ttl_dns_cache=300)
+            self.session = aiohttp.ClientSession(connector=conn, headers=self.headers, timeout=aiohttp.ClientTimeout(total=self.timeout))
+        return self
+
+    async def __aexit__(self, *exc):
+        if self.session is not None:
+            await self.session.close()
+
+    # the fetch methods, shared with git_mirror.GitMirror
+
+    async def fetch_file(self, project, path):
+        return await fetch_file_from_git(self, project, path)
+
+    async def fetch_tree(self, project):
+        return await fetch_tree(self, project)
+
+    async def fetch_blob(self, project, sha):
+        return await fetch_blob(self, project, sha)
+
+    async def get(self, url, etag=None, accept=None):
+        # (status, content, etag), a 304 if etag still matches
+        headers = {}
+        if accept is not None:
+            headers['Accept'] = accept
+        if etag is not None:
+            headers['If-None-Match'] = etag
+        async with self.semaphore:
+            while True:
+                token = await self.scheduler.acquire()
+                logging.debug("%s with %s" % (url, token.username))
+                try:
+                    async with self.session.get(url, headers=dict(headers, **token.headers)) as r:
+                        token.update(r.headers)
+                        logging.debug("API requests remaining %s" % r.headers.get('X-RateLimit-Remaining'))
+                        # out of requests or a secondary rate limit, try again when allowed
+                        if r.status in (403, 429) and (r.headers.get('X-RateLimit-Remaining') == '0' or 'Retry-After' in r.headers):
+                            retry_after = r.headers.get('Retry-After', '')
+                            if retry_after.isdigit():
+                                token.block(int(retry_after))
+                            elif token.remaining != 0:
+                                token.block(60)
+                            logging.debug("%s rate limited" % url)
+                            continue
+                        if r.status != 200:
+                            logging.debug("%s returned status %d" % (url, r.status))
+                            return r.status, None, None
+                        return r.status, await r.read(), r.headers.get('ETag')
+                finally:
+                    token.release()
+
+
+def split_repo(git_url):
+    # (user, repo) or None
     res = urlparse(git_url)
     try:
         _, user_name, repo = res.path.split('/')
     except ValueError:
         logging.error("couldn't split repo from %s" % git_url)
-        return 0
-    repo = repo.replace('.git', '')
-
-    # authenticate for rate limiting
-    auth_string = git_username + ':' + git_token
-    encoded = base64.b64encode(auth_string.encode('ascii'))
-    headers = {
-        "authorization" : 'Basic ' + encoded.decode('ascii'),
-        "Accept"        : "application/vnd.github.v3.raw",
-        }
-    api_url = 'https://api.github.com/repos/%s/%s/contents/%s' % (user_name, repo, path)
-
-    logging.debug(api_url)
-    r = requests.get(api_url, headers=headers)
-    requests_remaining = int(r.headers['X-RateLimit-Remaining'])
-    if requests_remaining == 0:
-        logging.error("no API requests remaining")
-        exit(1)
-
-    logging.debug("API requests remaining %d" % requests_remaining)
-    file_content = r.content
-    return file_content
-
-
-def get_pins(project):
-    # fetch the def
-    def_file = fetch_file_from_git(project, 'def/user_project_wrapper.def')
-    if def_file is None:
-        return 0
+        return None
+    return user_name, repo.replace('.git', '')
+
+
+async def fetch_cached(client, key, api_url, accept=None):
+    # content from the API, revalidating any cached copy, or just the cached copy offline. None if it isn't there
+    cache = client.cache
+    entry = cache.get(key) if cache is not None else None
+    if client.offline:
+        if entry is None:
+            logging.debug("%s not in the file cache" % key)
+            return None
+        return cache.read(key)
+
+    try:
+        status, content, etag = await client.get(api_url, entry['etag'] if entry else None, accept)
+        if status == 304:
+            content = cache.read(key)
+            if content is None:
+                # the cached copy has gone, fetch it again
+                status, content, etag = await client.get(api_url, None, accept)
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        logging.warning("couldn't fetch %s: %s" % (api_url, repr(e)))
+        # better an old copy than nothing
+        return cache.read(key) if entry else None
+    if status == 200 and cache is not None:
+        cache.put(key, content, etag)
+    return content
+
+
+async def fetch_file_from_git(client, project, path, ref=None):
+    # content of a file on a branch, tag or commit, default branch if ref is None. None if it isn't there
+    repo = split_repo(project['giturl'])
+    if repo is None:
+        return None
+    api_url = '%s/repos/%s/%s/contents/%s' % (client.api_url, repo[0], repo[1], path)
+    if ref is not None:
+        api_url += '?ref=' + ref
+    return await fetch_cached(client, '/'.join([repo[0], repo[1], ref or 'HEAD', path]), api_url)
+
+
+async def fetch_tree(client, project):
+    # path to blob sha of every file in the repo's default branch, or None if we can't tell
+    repo = split_repo(project['giturl'])
+    if repo is None:
+        return None
+    api_url = '%s/repos/%s/%s/git/trees/HEAD?recursive=1' % (client.api_url, repo[0], repo[1])
+    content = await fetch_cached(client, '/'.join([repo[0], repo[1], 'HEAD', '']), api_url, "application/vnd.github+json")
+    if content is None:
+        return None
+    tree = json.loads(content)
+    if tree.get('truncated'):
+        # too big to list in one go
+        logging.debug("tree of %s truncated" % project['giturl'])
+        return None
+    return {item['path']: item['sha'] for item in tree['tree'] if item['type'] == 'blob'}
+
+
+async def fetch_blob(client, project, sha):
+    # a blob never changes, so a cached one is used without asking and the same blob in another repo is shared
+    key = 'blob/' + sha
+    if client.cache is not None and client.cache.get(key) is not None:
+        content = client.cache.read(key)
+        if content is not None:
+            return content
+    if sha not in client.blobs:
+        repo = split_repo(project['giturl'])
+        api_url = '%s/repos/%s/%s/git/blobs/%s' % (client.api_url, repo[0], repo[1], sha)
+        client.blobs[sha] = asyncio.ensure_future(fetch_cached(client, key, api_url))
+    return await asyncio.shield(client.blobs[sha])
+
+
+def parse_macros(def_file):
+    # the DEF parser is only needed here
+    from def_parser import DefParser
 
     # write to temp file for DefParser
     fp = tempfile.NamedTemporaryFile(mode='wb')
@@ -52,20 +282,41 @@ def get_pins(project):
     d = DefParser(fp.name)
     d.parse()
     fp.close()
-    macros = []
-
-    # now we have macros
     try:
-        for macro in d.components.comps:
-            macros.append(macro.macro)
+        return [macro.macro for macro in d.components.comps]
     except AttributeError:
+        return None
+
+
+async def get_pins(client, project):
+    # list the repo once, so only the files that are there are fetched
+    def_path = 'def/user_project_wrapper.def'
+    tree = await client.fetch_tree(project)
+
+    # fetch the def
+    if tree is None:
+        def_file = await client.fetch_file(project, def_path)
+    elif def_path in tree:
+        def_file = await client.fetch_blob(project, tree[def_path])
+    else:
+        def_file = None
+    if def_file is None:
+        return 0
+
+    # now we have macros
+    macros = await asyncio.get_running_loop().run_in_executor(None, parse_macros, def_file)
+    if macros is None:
         logging.warning("no macros found in %s" % project['giturl'])
         return 0
 
-    # for each macro, fetch the lef
+    # fetch the lef of each macro once, all at once
+    lef_paths = sorted(set('lef/' + macro + '.lef' for macro in macros))
+    if tree is None:
+        lef_files = await asyncio.gather(*[client.fetch_file(project, path) for path in lef_paths])
+    else:
+        lef_files = await asyncio.gather(*[client.fetch_blob(project, tree[path]) for path in lef_paths if path in tree])
     max_pin = 0
-    for macro in macros:
-        lef_file = fetch_file_from_git(project, 'lef/' + macro + '.lef')
+    for lef_file in lef_files:
         if lef_file is None:
             pin_count = 0
         else:
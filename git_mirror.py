@@ -0,0 +1,114 @@
+"""
+Git mirror
+Local shallow, blobless clones of the project repos, so --get-file and --get-pins read from disk instead of the
+GitHub API. A repo is cloned the first time it is used and fetched once per run after that; the files themselves
+are fetched from the remote by git as they are first read, so the large ones we never look at are never downloaded.
+"""
+import os, asyncio, logging
+from urllib.parse import urlparse
+
+# never ask for a password, a missing repo would hang the run waiting for one
+git_env = dict(os.environ, GIT_TERMINAL_PROMPT='0')
+# no transport at all, so reading a file that isn't there yet can't fetch it
+offline_env = dict(git_env, GIT_ALLOW_PROTOCOL='none')
+
+
+class GitMirror:
+    """
+    GitMirror has the same fetch methods as get_pins.GitHubClient, with at most concurrency git commands running.
+    Offline, the repos are neither cloned nor fetched and only what is already in them is read.
+    """
+
+    def __init__(self, path, concurrency=10, offline=False):
+        self.path = path
+        self.offline = offline
+        self.semaphore = asyncio.Semaphore(concurrency)
+        # git url to the task cloning or fetching it
+        self.updates = {}
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        pass
+
+    async def git(self, *args):
+        # (return code, output)
+        async with self.semaphore:
+            proc = await asyncio.create_subprocess_exec('git', *args, stdin=asyncio.subprocess.DEVNULL, stdout=asyncio.subprocess.PIPE,
+                                                        stderr=asyncio.subprocess.PIPE, env=offline_env if self.offline else git_env)
+            out, err = await proc.communicate()
+        if proc.returncode:
+            logging.debug("git %s: %s" % (' '.join(args), err.decode(errors='replace').strip()))
+        return proc.returncode, out
+
+    def repo_path(self, git_url):
+        # where the clone of a repo goes, None if it isn't a url git can clone
+        url = urlparse(git_url)
+        name = url.path.strip('/')
+        if url.scheme not in ('https', 'http', 'ssh', 'git', 'file') or not name:
+            return None
+        if name.endswith('.git'):
+            name = name[:-len('.git')]
+        return os.path.join(self.path, url.hostname or 'local', name + '.git')
+
+    async def update(self, project):
+        # the local repo, cloned or fetched once per run, None if there isn't one
+        url = project['giturl']
+        if url not in self.updates:
+            self.updates[url] = asyncio.ensure_future(self.clone_or_fetch(url))
+        return await asyncio.shield(self.updates[url])
+
+    async def clone_or_fetch(self, url):
+        path = self.repo_path(url)
+        if path is None:
+            logging.error("couldn't get a repo from %s" % url)
+            return None
+        exists = os.path.exists(path)
+        if self.offline:
+            return path if exists else None
+        if not exists:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            code, _ = await self.git('clone', '--quiet', '--bare', '--depth', '1', '--filter=blob:none', url, path)
+            if code:
+                logging.warning("couldn't clone %s" % url)
+                return None
+            return path
+        # bring the default branch up to date
+        code, head = await self.git('-C', path, 'symbolic-ref', 'HEAD')
+        if not code:
+            code, _ = await self.git('-C', path, 'fetch', '--quiet', '--depth', '1', '--filter=blob:none', 'origin', '+HEAD:' + head.decode().strip())
+        if code:
+            logging.warning("couldn't fetch %s, using the copy we have" % url)
+        return path
+
+    async def fetch_file(self, project, path):
+        repo = await self.update(project)
+        if repo is None:
+            return None
+        code, content = await self.git('-C', repo, 'cat-file', 'blob', 'HEAD:' + path)
+        return None if code else content
+
+    async def fetch_tree(self, project):
+        # path to blob sha of every file, as get_pins.fetch_tree
+        repo = await self.update(project)
+        if repo is None:
+            return None
+        code, out = await self.git('-C', repo, 'ls-tree', '-r', '-z', 'HEAD')
+        if code:
+            return None
+        tree = {}
+        for line in out.decode(errors='replace').split('\0'):
+            if line:
+                info, name = line.split('\t', 1)
+                _, kind, sha = info.split()
+                if kind == 'blob':
+                    tree[name] = sha
+        return tree
+
+    async def fetch_blob(self, project, sha):
+        repo = await self.update(project)
+        if repo is None:
+            return None
+        code, content = await self.git('-C', repo, 'cat-file', 'blob', sha)
+        return None if code else content
@@ -1 +1 @@
-flake8   --ignore E203,E123,E501,E221,E401  efabless_tool.py
+flake8   --ignore E203,E123,E501,E221,E401  efabless_tool.py benchmark.py page_parser.py project_store.py query_daemon.py file_cache.py git_mirror.py
@@ -0,0 +1,115 @@
+"""
+Project page parser
+Pulls the title, the project detail fields and the shuttle header out of an
+efabless project page from the parser events, without building the whole tree.
+"""
+from html.parser import HTMLParser
+
+FIELD_CLASS = 'list-group-item py-2'
+HEADER_CLASS = 'text-dark-50 font-weight-bold'
+# their text isn't part of the page text
+SKIP_TAGS = {'script', 'style'}
+VOID_TAGS = {'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'link', 'meta', 'param', 'source', 'track', 'wbr'}
+
+
+class ProjectPageParser(HTMLParser):
+    """
+    ProjectPageParser collects the same data as the BeautifulSoup lookups did:
+    the first title, the first h6 and p text of each field div and the text of each header span.
+    """
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.title = None
+        # field divs in page order
+        self.fields = []
+        self.headers = []
+        # open elements, each is [tag, text list or None, field]
+        self.stack = []
+        # the field div we are in, if any
+        self.field = None
+
+    def handle_starttag(self, tag, attrs):
+        if tag in VOID_TAGS:
+            return
+        text = None
+        field = None
+        classes = ' '.join(dict(attrs).get('class', '').split())
+        if tag == 'title' and self.title is None:
+            text = []
+            self.title = text
+        elif tag == 'div' and classes == FIELD_CLASS:
+            field = {'h6': None, 'p': None}
+            self.fields.append(field)
+            self.field = field
+        elif tag == 'span' and classes == HEADER_CLASS:
+            text = []
+            self.headers.append(text)
+        elif tag in ('h6', 'p') and self.field is not None and self.field[tag] is None:
+            text = []
+            self.field[tag] = text
+        self.stack.append([tag, text, field])
+
+    def handle_startendtag(self, tag, attrs):
+        # nothing we want can be self closing
+        pass
+
+    def handle_endtag(self, tag):
+        # close everything up to the most recent matching tag, ignore stray end tags
+        for i in range(len(self.stack) - 1, -1, -1):
+            if self.stack[i][0] == tag:
+                break
+        else:
+            return
+        while len(self.stack) > i:
+            _, _, field = self.stack.pop()
+            if field is not None:
+                self.leave_field()
+
+    def handle_data(self, data):
+        if self.stack and self.stack[-1][0] in SKIP_TAGS:
+            return
+        for _, text, _ in self.stack:
+            if text is not None:
+                text.append(data)
+
+    def leave_field(self):
+        # back to any enclosing field div
+        self.field = None
+        for _, _, outer in reversed(self.stack):
+            if outer is not None:
+                self.field = outer
+                break
+
+    def close(self):
+        super().close()
+        # elements left open at the end of the page are closed
+        while self.stack:
+            _, _, field = self.stack.pop()
+            if field is not None:
+                self.leave_field()
+
+    def get_title(self):
+        return None if self.title is None else ''.join(self.title)
+
+    def get_fields(self):
+        # list of (h6 text, p text)
+        for field in self.fields:
+            if field['h6'] is None or field['p'] is None:
+                raise ValueError("field without h6 or p")
+        return [(''.join(field['h6']), ''.join(field['p'])) for field in self.fields]
+
+    def get_headers(self):
+        return [''.join(text) for text in self.headers]
+
+
+def parse(content):
+    """
+    parse a project page
+    :param content: the page html
+    :return: (title, fields, headers)
+    """
+    parser = ProjectPageParser()
+    parser.feed(content)
+    parser.close()
+    return parser.get_title(), parser.get_fields(), parser.get_headers()
@@ -0,0 +1,427 @@
+"""
+Project store
+SQLite database of the project info, one row per project with an index on each column we select on.
+The inverted index of the words in each project for searching and the trigram index of the summaries for fuzzy searching
+are kept in a second database next to it, built the first time a search needs them and again when the projects change.
+"""
+import os, re, math
+
+# same fields as key_map in efabless_tool, id first
+fields = ['id', 'precheck', 'tapeout', 'giturl', 'mpw', 'owner', 'process', 'summary', 'selected']
+indexed_fields = ['mpw', 'owner', 'process', 'tapeout', 'selected']
+# fields in the search index and how much a match in each counts
+search_fields = {'summary': 1, 'owner': 2, 'giturl': 1}
+# parts of a git url that say nothing about the project
+url_stopwords = {'http', 'https', 'www', 'com', 'org', 'git', 'github', 'gitlab'}
+# largest part of the database file to memory map
+mmap_size = 1 << 28
+# the search indexes of a store, eg projects.db.index
+index_suffix = '.index'
+
+
+def tokenize(text):
+    # each part of a hyphenated word and the parts joined, so SAR-ADC is found by sar, adc and saradc
+    terms = []
+    for word in re.findall(r'[a-z0-9]+(?:-[a-z0-9]+)*', text.lower()):
+        parts = word.split('-')
+        terms += parts
+        if len(parts) > 1:
+            terms.append(''.join(parts))
+    return terms
+
+
+def query_terms(text):
+    # a hyphenated word in a search is looked up joined, like the original --ip search, so op-amp matches opamp
+    return [''.join(word.split('-')) for word in re.findall(r'[a-z0-9]+(?:-[a-z0-9]+)*', text.lower())]
+
+
+def trigrams(text):
+    # everything but letters and numbers is dropped, so op-amp, op amp and opamp are the same
+    text = re.sub(r'[^a-z0-9]', '', text.lower())
+    return set(text[i:i + 3] for i in range(len(text) - 2))
+
+
+def project_terms(project):
+    # term to weight for one project
+    terms = {}
+    for field, weight in search_fields.items():
+        for term in tokenize(project[field]):
+            if field == 'giturl' and term in url_stopwords:
+                continue
+            terms[term] = terms.get(term, 0) + weight
+    return terms
+
+
+def connect(path):
+    # an open connection, eg from load_into_memory, is used as it is
+    if not isinstance(path, str):
+        return path
+    # only loaded when the store is used, a query daemon client doesn't need it
+    import sqlite3
+    if not os.path.exists(path):
+        raise FileNotFoundError(path)
+    conn = sqlite3.connect(path)
+    conn.row_factory = sqlite3.Row
+    # read the file through a memory map rather than copying pages into sqlite's cache
+    conn.execute('PRAGMA mmap_size = %d' % mmap_size)
+    return conn
+
+
+def disconnect(conn, path):
+    # only close connections we opened
+    if conn is not path:
+        conn.close()
+
+
+def load_into_memory(path):
+    """
+    copy the store into memory, for the query daemon
+    :param path: the database file
+    :return: a connection that can be passed to the other functions in place of the path
+    """
+    import sqlite3
+    disk = connect(path)
+    conn = sqlite3.connect(':memory:', check_same_thread=False)
+    disk.backup(conn)
+    disk.close()
+    conn.row_factory = sqlite3.Row
+    # the search indexes go in with the projects
+    write_index(conn, load(conn, columns=list(search_fields)))
+    return conn
+
+
+def save(path, projects):
+    """
+    write a new store with the given projects, replacing any existing one
+    :param path: the database file
+    :param projects: list of project dicts
+    :return: void
+    """
+    import sqlite3
+    tmp_path = path + '.tmp'
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    conn = sqlite3.connect(tmp_path)
+    write_projects(conn, projects)
+    conn.close()
+    os.replace(tmp_path, path)
+
+
+def write_projects(conn, projects):
+    columns = ', '.join('%s TEXT' % field for field in fields[1:])
+    conn.execute('CREATE TABLE projects (id INTEGER PRIMARY KEY, %s)' % columns)
+    for field in indexed_fields:
+        conn.execute('CREATE INDEX projects_%s ON projects (%s)' % (field, field))
+    conn.executemany('INSERT INTO projects VALUES (%s)' % ', '.join('?' * len(fields)),
+                     [[int(project['id'])] + [project[field] for field in fields[1:]] for project in projects])
+    conn.commit()
+
+
+def write_index(conn, projects):
+    # the terms and trigrams tables, keyed by term or gram so a lookup reads them in order without a separate index
+    conn.execute('CREATE TABLE terms (term TEXT, id INTEGER, weight REAL, PRIMARY KEY (term, id)) WITHOUT ROWID')
+    conn.executemany('INSERT INTO terms VALUES (?, ?, ?)',
+                     [(term, int(project['id']), weight) for project in projects for term, weight in project_terms(project).items()])
+    conn.execute('CREATE TABLE trigrams (gram TEXT, id INTEGER, PRIMARY KEY (gram, id)) WITHOUT ROWID')
+    conn.executemany('INSERT INTO trigrams VALUES (?, ?)',
+                     [(gram, int(project['id'])) for project in projects for gram in trigrams(project['summary'])])
+    conn.commit()
+
+
+def store_version(path):
+    # changes whenever the store is written
+    stat = os.stat(path)
+    return '%d %d' % (stat.st_mtime_ns, stat.st_size)
+
+
+def connect_index(path):
+    """
+    a connection to the store with its search indexes, building them if they are missing or older than the store
+    :param path: the database file or a connection from load_into_memory, which has the indexes already
+    :return: connection, close it with disconnect
+    """
+    conn = connect(path)
+    if conn is path:
+        return conn
+    import sqlite3
+    index_path = path + index_suffix
+    version = store_version(path)
+    try:
+        index = sqlite3.connect('file:%s?mode=ro' % index_path, uri=True)
+        try:
+            current = index.execute('SELECT version FROM source').fetchone()[0] == version
+        finally:
+            index.close()
+    except sqlite3.Error:
+        current = False
+    if not current:
+        # a file per process, so two commands building it at once don't write over each other
+        tmp_path = '%s.%d.tmp' % (index_path, os.getpid())
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        index = sqlite3.connect(tmp_path)
+        index.execute('CREATE TABLE source (version TEXT)')
+        index.execute('INSERT INTO source VALUES (?)', (version,))
+        write_index(index, load(conn, columns=list(search_fields)))
+        index.close()
+        os.replace(tmp_path, index_path)
+    conn.execute('ATTACH DATABASE ? AS search_index', (index_path,))
+    return conn
+
+
+def row_to_project(row):
+    project = dict(row)
+    project['id'] = str(project['id'])
+    return project
+
+
+def load(path, expression=None, columns=None, **where):
+    """
+    get projects sorted by id
+    :param path: the database file or a connection
+    :param expression: a filter expression, see compile_where
+    :param columns: the fields to read, id is always included. Default is all of them
+    :param where: field=value pairs the projects must match
+    :return: list of project dicts
+    """
+    select = '*'
+    if columns is not None:
+        for field in columns:
+            if field not in fields:
+                raise ValueError("unknown field %s" % field)
+        # in table order, without repeats
+        select = ', '.join(field for field in fields if field == 'id' or field in columns)
+    conditions = []
+    params = []
+    for field in where:
+        if field not in fields:
+            raise ValueError("unknown field %s" % field)
+        conditions.append('%s = ?' % field)
+        params.append(where[field])
+    if expression:
+        sql, expression_params = compile_where(expression)
+        conditions.append('(%s)' % sql)
+        params += expression_params
+    sql = 'SELECT %s FROM projects' % select
+    if conditions:
+        sql += ' WHERE ' + ' AND '.join(conditions)
+    sql += ' ORDER BY id'
+    conn = connect(path)
+    try:
+        return [row_to_project(row) for row in conn.execute(sql, params)]
+    finally:
+        disconnect(conn, path)
+
+
+where_token = re.compile(r"""\s*(?:(?P<paren>[()])|(?P<field>\w+)\s*(?P<op>!=|=|~)\s*(?P<value>"[^"]*"|'[^']*'|[^\s()]+)|(?P<word>\w+))""")
+
+
+def compile_where(expression):
+    """
+    compile a filter expression to SQL so it runs in the database and can use the indexes
+    field=value is an exact match, field!=value the opposite and field~value a case insensitive substring match.
+    Conditions are combined with and, or, not and parentheses, eg:
+    tapeout=Succeeded and process~130B and (mpw=MPW-7 or mpw=MPW-8)
+    :param expression: the filter expression
+    :return: (sql, params)
+    """
+    tokens = []
+    pos = 0
+    expression = expression.strip()
+    while pos < len(expression):
+        m = where_token.match(expression, pos)
+        if m is None:
+            raise ValueError("can't parse filter at '%s'" % expression[pos:])
+        tokens.append(m)
+        pos = m.end()
+
+    params = []
+
+    def peek():
+        return tokens[0] if tokens else None
+
+    def is_word(token, word):
+        return token is not None and token.group('word') is not None and token.group('word').lower() == word
+
+    def parse_or():
+        sql = parse_and()
+        while is_word(peek(), 'or'):
+            tokens.pop(0)
+            sql = '%s OR %s' % (sql, parse_and())
+        return sql
+
+    def parse_and():
+        sql = parse_not()
+        while is_word(peek(), 'and'):
+            tokens.pop(0)
+            sql = '%s AND %s' % (sql, parse_not())
+        return sql
+
+    def parse_not():
+        if is_word(peek(), 'not'):
+            tokens.pop(0)
+            return 'NOT %s' % parse_not()
+        return parse_condition()
+
+    def parse_condition():
+        if not tokens:
+            raise ValueError("filter ends too soon")
+        token = tokens.pop(0)
+        if token.group('paren') == '(':
+            sql = parse_or()
+            if not tokens or tokens.pop(0).group('paren') != ')':
+                raise ValueError("missing ) in filter")
+            return '(%s)' % sql
+        if token.group('field') is None:
+            raise ValueError("expected a condition at '%s'" % token.group(0).strip())
+        field, op, value = token.group('field'), token.group('op'), token.group('value')
+        if field not in fields:
+            raise ValueError("unknown field %s" % field)
+        if value[0] in '"\'':
+            value = value[1:-1]
+        if op == '~':
+            params.append('%' + value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%')
+            return "%s LIKE ? ESCAPE '\\'" % field
+        params.append(int(value) if field == 'id' else value)
+        return '%s %s ?' % (field, op)
+
+    sql = parse_or()
+    if tokens:
+        raise ValueError("unexpected '%s' in filter" % tokens[0].group(0).strip())
+    return sql, params
+
+
+def parse_query(query):
+    """
+    terms are ANDed, 'or' or | separates alternatives and a trailing * matches any word starting with the term
+    :param query: eg 'op-amp or adc dac'
+    :return: list of alternatives, each a list of (term, prefix)
+    """
+    groups = [[]]
+    for word in query.replace('|', ' or ').split():
+        if word.lower() == 'or':
+            groups.append([])
+        elif word.lower() != 'and':
+            prefix = word.endswith('*')
+            groups[-1] += [(term, prefix) for term in query_terms(word)]
+    return [group for group in groups if group]
+
+
+def lookup(conn, term, prefix):
+    # project id to weight for a term
+    if prefix:
+        # terms are only a-z and 0-9, { sorts after them
+        rows = conn.execute('SELECT id, SUM(weight) FROM terms WHERE term >= ? AND term < ? GROUP BY id', (term, term + '{'))
+    else:
+        rows = conn.execute('SELECT id, weight FROM terms WHERE term = ?', (term,))
+    return dict(rows.fetchall())
+
+
+def search(path, query):
+    """
+    search the inverted index
+    :param path: the database file or a connection
+    :param query: see parse_query
+    :return: matching project ids, best match first
+    """
+    conn = connect_index(path)
+    try:
+        total = conn.execute('SELECT COUNT(*) FROM projects').fetchone()[0]
+        scores = {}
+        for group in parse_query(query):
+            group_scores = None
+            for term, prefix in group:
+                matches = lookup(conn, term, prefix)
+                # rarer terms count for more
+                idf = math.log(1 + total / max(1, len(matches)))
+                if group_scores is None:
+                    group_scores = {id: weight * idf for id, weight in matches.items()}
+                else:
+                    group_scores = {id: score + matches[id] * idf for id, score in group_scores.items() if id in matches}
+            for id, score in group_scores.items():
+                scores[id] = max(scores.get(id, 0), score)
+    finally:
+        disconnect(conn, path)
+    return [str(id) for id in sorted(scores, key=lambda id: (-scores[id], id))]
+
+
+def fuzzy_search(path, query, top, ids=None):
+    """
+    search the summaries by the fraction of the query's trigrams they contain
+    :param path: the database file or a connection
+    :param query: any text
+    :param top: how many projects to return
+    :param ids: only search these project ids, default is all of them
+    :return: list of (project id, similarity from 0 to 1), best match first
+    """
+    grams = trigrams(query)
+    if not grams:
+        return []
+    sql = 'SELECT id, COUNT(*) AS shared FROM trigrams WHERE gram IN (%s)' % ', '.join('?' * len(grams))
+    if ids is not None:
+        # a temporary table rather than parameters, there can be more ids than sqlite allows parameters
+        sql += ' AND id IN (SELECT id FROM temp.selection)'
+    sql += ' GROUP BY id ORDER BY shared DESC, id LIMIT ?'
+    conn = connect_index(path)
+    try:
+        if ids is not None:
+            conn.execute('CREATE TEMP TABLE selection (id INTEGER PRIMARY KEY)')
+            conn.executemany('INSERT OR IGNORE INTO temp.selection VALUES (?)', [(int(id),) for id in ids])
+        try:
+            rows = conn.execute(sql, list(grams) + [top]).fetchall()
+        finally:
+            if ids is not None:
+                conn.execute('DROP TABLE temp.selection')
+    finally:
+        disconnect(conn, path)
+    return [(str(id), shared / len(grams)) for id, shared in rows]
+
+
+def diff(old_projects, new_projects):
+    """
+    changes between two snapshots of the projects, in one pass over each
+    :param old_projects: list of project dicts
+    :param new_projects: list of project dicts
+    :return: generator of change dicts, id and change of added, removed or changed.
+        Added and removed changes have the project, changed ones the fields that differ as field: [old, new]
+    """
+    old_by_id = {project['id']: project for project in old_projects}
+    for project in new_projects:
+        old = old_by_id.pop(project['id'], None)
+        if old is None:
+            yield {'id': project['id'], 'change': 'added', 'project': project}
+        elif old != project:
+            changed = {field: [old.get(field), value] for field, value in project.items() if old.get(field) != value}
+            yield {'id': project['id'], 'change': 'changed', 'fields': changed}
+    # what's left has gone
+    for id, project in old_by_id.items():
+        yield {'id': id, 'change': 'removed', 'project': project}
+
+
+def read_pickle(pickle_path):
+    # the list of project dicts in a projects.pkl from older versions of the tool
+    import pickle
+    with open(pickle_path, 'rb') as fh:
+        return pickle.load(fh)
+
+
+def load_pickle(pickle_path):
+    """
+    a projects.pkl converted to a store in memory, so it can be read like a database file
+    :return: a connection that can be passed to the other functions in place of the path
+    """
+    import sqlite3
+    conn = sqlite3.connect(':memory:')
+    conn.row_factory = sqlite3.Row
+    write_projects(conn, read_pickle(pickle_path))
+    return conn
+
+
+def import_pickle(pickle_path, path):
+    """
+    convert a projects.pkl from older versions of the tool
+    :return: number of projects imported
+    """
+    projects = read_pickle(pickle_path)
+    save(path, projects)
+    return len(projects)
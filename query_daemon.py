@@ -0,0 +1,104 @@
+"""
+Query daemon
+Keeps the project store in memory and answers query commands over a Unix socket, so a pipeline of
+tool invocations doesn't start from scratch each time. The store is reloaded when the file changes.
+"""
+import os, sys, json, signal, socket, logging
+import project_store
+
+
+class AlreadyRunning(Exception):
+    pass
+
+
+def read_all(sock):
+    chunks = []
+    while True:
+        chunk = sock.recv(1 << 16)
+        if not chunk:
+            return b''.join(chunks)
+        chunks.append(chunk)
+
+
+def request(socket_path, argv, stdin_lines):
+    """
+    send a query to the daemon
+    :param socket_path: the daemon's socket
+    :param argv: the command line arguments
+    :param stdin_lines: lines piped in, or None
+    :return: dict of output, errors and status, or None if the daemon isn't running
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+    except (FileNotFoundError, ConnectionRefusedError):
+        sock.close()
+        return None
+    with sock:
+        sock.sendall(json.dumps({'argv': argv, 'stdin': stdin_lines}).encode('utf-8'))
+        sock.shutdown(socket.SHUT_WR)
+        return json.loads(read_all(sock))
+
+
+def serve(path, socket_path, handle):
+    """
+    answer queries until interrupted
+    :param path: the project store
+    :param socket_path: where to listen
+    :param handle: function of (argv, stdin lines, store connection) returning the reply dict
+    :return: void
+    """
+    # a socket left over from a daemon that died is in the way, but one that answers belongs to a running daemon
+    if os.path.exists(socket_path):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(socket_path)
+        except (FileNotFoundError, ConnectionRefusedError):
+            os.remove(socket_path)
+        else:
+            raise AlreadyRunning("a query daemon is already listening on %s" % socket_path)
+        finally:
+            probe.close()
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(socket_path)
+    server.listen()
+    logging.info("query daemon listening on %s" % socket_path)
+    # stop cleanly when killed too, removing the socket
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    # a client that goes away before its reply is read should be an error on that connection, not the end of the daemon
+    signal.signal(signal.SIGPIPE, signal.SIG_IGN)
+
+    db = None
+    loaded = None
+    try:
+        while True:
+            conn, _ = server.accept()
+            with conn:
+                try:
+                    data = read_all(conn)
+                    if not data:
+                        # nothing asked, eg another daemon checking whether this one is running
+                        continue
+                    query = json.loads(data)
+                    try:
+                        modified = os.stat(path).st_mtime_ns
+                        if modified != loaded:
+                            db = project_store.load_into_memory(path)
+                            loaded = modified
+                            logging.info("loaded project cache %s" % path)
+                        reply = handle(query['argv'], query['stdin'], db)
+                    except FileNotFoundError:
+                        reply = {'output': '', 'errors': "project cache %s not found, use --update-cache to build it\n" % path, 'status': 1}
+                    except Exception as e:
+                        # one bad query shouldn't take the daemon down
+                        logging.exception("query %r failed" % (query,))
+                        reply = {'output': '', 'errors': "query failed: %s\n" % e, 'status': 1}
+                    conn.sendall(json.dumps(reply).encode('utf-8'))
+                except (OSError, ValueError) as e:
+                    # the client went away or didn't send a query
+                    logging.warning("dropped a connection: %s" % e)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        os.remove(socket_path)
@@ -6,8 +6,7 @@ Date: August 2016
 """
 
 SCALE = 2000
-import matplotlib.pyplot as plt
-import numpy as np
+# matplotlib and numpy are only imported by the functions that draw or shuffle, they are slow to load
 import math
 
 
@@ -109,6 +108,7 @@ def draw_obs(obs, color):
     Helper method to draw a OBS object
     :return: void
     """
+    import matplotlib.pyplot as plt
     # process each Layer
     for layer in obs.info["LAYER"]:
         for shape in layer.shapes:
@@ -125,6 +125,7 @@ def draw_port(port, color):
     Helper method to draw a PORT object
     :return: void
     """
+    import matplotlib.pyplot as plt
     # process each Layer
     for layer in port.info["LAYER"]:
         for shape in layer.shapes:
@@ -341,6 +342,7 @@ def sort_vias_by_row(layout_area, row_height, vias):
 
 
 def randomize(dataset, labels):
+    import numpy as np
     permutation = np.random.permutation(labels.shape[0])
     shuffled_dataset = dataset[permutation, :]
     shuffled_labels = labels[permutation]